@@ -100,7 +100,7 @@ class Error(Exception):
     """SIS Error"""
 
     def __init__(self, error, http_status_code=None, 
-                 code=None, response_dict={}):
+                 code=None, response_dict={}, headers=None):
         """
         args:
             error: string representing error description
@@ -108,11 +108,13 @@ class Error(Exception):
             http_status_code: HTTP status code
             response_dict: dictionary representing encoded 
                 http response body 
+            headers: dict containing http response headers
         """
         self.error = error
         self.http_status_code = http_status_code
         self.code = code
         self.response_dict = response_dict
+        self.headers = headers if headers is not None else {}
 
         super(Error, self).__init__(self.__str__())
 
@@ -129,5 +131,23 @@ class Error(Exception):
         return self.error
 
 
+class ConflictError(Error):
+    """Raised when a conditional (compare-and-swap) update fails
+    because the stored object does not match the expected values"""
+
+    def __init__(self, error, http_status_code=None,
+                 code=None, response_dict={}, headers=None, current=None):
+        """
+        args:
+            current: dict-like Response representing the object as
+                currently stored on the server, or None if unavailable
+        """
+        self.current = current
+
+        super(ConflictError, self).__init__(
+            error, http_status_code=http_status_code,
+            code=code, response_dict=response_dict, headers=headers)
+
+
 from .client import Client
 
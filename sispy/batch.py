@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import threading
+
+from . import Error, NullHandler
+from .futures import Future
+
+if sys.version_info[0] >= 3:
+    import queue
+else:
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+
+class Batch(object):
+
+    """Runs independent calls concurrently on up to max_workers threads.
+
+    Usable as a context manager, leaving the block waits for all the
+    submitted calls and stops the worker threads.
+
+    Calls share the client, which is safe for concurrent use; with requests
+    the worker threads get their own sessions over one connection pool.
+    Requests still pass through the client's governor, which bounds the
+    number actually in flight.
+
+        with client.batch() as batch:
+            schema = batch.submit(client.schemas.get, 'test_schema')
+            page = batch.submit(client.entities('test_schema').fetch_page,
+                                {'limit': 1})
+
+        print(schema.result()['name'], page.result()._meta.total_count)
+
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+        self._futures = []
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs), returns a Future"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise Error('{0} is closed'.format(self.__class__.__name__))
+            self._futures.append(future)
+            self._queue.put((future, fn, args, kwargs))
+
+            # start a worker unless an idle one will pick the call up
+            if self._idle:
+                self._idle -= 1
+            elif len(self._threads) < self.max_workers:
+                t = threading.Thread(target=self._work, name='sispy-batch')
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        return future
+
+    def map(self, fn, *iterables):
+        """Submits fn for each set of arguments, returns a list of Futures"""
+        return [self.submit(fn, *args) for args in zip(*iterables)]
+
+    def wait(self):
+        """Blocks until all the submitted calls completed"""
+        for future in list(self._futures):
+            future.exception()
+
+    def results(self):
+        """Waits for all the submitted calls, returns a list of their
+        results in the order submitted. Calls that failed with sispy.Error
+        are represented by the Error instance.
+
+        Other exceptions are re-raised.
+
+        """
+        results = []
+        for future in list(self._futures):
+            e = future.exception()
+            if e is None:
+                results.append(future.result())
+            elif isinstance(e, Error):
+                results.append(e)
+            else:
+                raise e
+        return results
+
+    def close(self):
+        """Waits for all the submitted calls and stops the worker threads"""
+        with self._lock:
+            self._closed = True
+            threads = list(self._threads)
+            for _ in threads:
+                self._queue.put(None)
+        for t in threads:
+            t.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            future, fn, args, kwargs = item
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+            with self._lock:
+                self._idle += 1
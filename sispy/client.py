@@ -2,8 +2,12 @@
 
 import base64
 import logging
+import os
+import threading
+import time
 
-from . import http, endpoint, NullHandler
+from . import Error, http, endpoint, routing, join, batch as batch_, \
+    governor as governor_, NullHandler
 
 LOG = logging.getLogger(__name__)
 LOG.addHandler(NullHandler())
@@ -14,14 +18,50 @@ class Client(object):
     """SIS client"""
 
     def __init__(self, url, version=1.1, auth_token=None,
-                 http_keep_alive=True):
+                 http_keep_alive=True, governor=True, router_options=None,
+                 warm_up_connections=0, http_handler=None):
 
         self.version = version
-        self.base_uri = '{0}/api/v{1}'.format(url.rstrip('/'), self.version)
         self.auth_token = auth_token
 
-        # get http handler
-        self._http_handler = http.get_handler(http_keep_alive=http_keep_alive)
+        # url may be a list of equivalent API nodes,
+        # the first one is preferred for writes
+        if isinstance(url, (list, tuple)):
+            urls = url
+        else:
+            urls = [url]
+        base_uris = ['{0}/api/v{1}'.format(u.rstrip('/'), self.version)
+                     for u in urls]
+        self.base_uri = base_uris[0]
+
+        self.router = None
+        if len(base_uris) > 1:
+            self.router = routing.Router(base_uris, probe=self._probe,
+                                         **(router_options or {}))
+
+        # get http handler, unless one is provided e.g.
+        # emulator.EmulatorHandler()
+        if http_handler is None:
+            http_handler = http.get_handler(http_keep_alive=http_keep_alive)
+        self._http_handler = http_handler
+
+        # transports are rebuilt when used from a forked child,
+        # see after_fork()
+        self.warm_up_connections = warm_up_connections
+        self._pid = os.getpid()
+        # pid -> lock serializing after_fork() in that process, locks
+        # inherited from the parent may be held by threads that do not
+        # exist in the child
+        self._fork_locks = {}
+
+        # concurrency and rate governor, by default shared by all clients
+        # of the same server(s), None or False disables it
+        if governor is True:
+            governor = governor_.get_governor(','.join(base_uris))
+        self.governor = governor or None
+
+        # reference resolver, caches referenced entities across calls
+        self.resolver = join.Resolver(self)
 
         # api endpoints
         self.schemas = endpoint.Endpoint('schemas', self)
@@ -35,8 +75,134 @@ class Client(object):
     def tokens(self, username):
         return endpoint.Endpoint('users/{0}/tokens'.format(username), self)
 
+    def resolve(self, schema_name, items, paths):
+        """Replaces references to other schemas' entities in items in place,
+        see join.Resolver.resolve()"""
+        return self.resolver.resolve(schema_name, items, paths)
+
+    def batch(self, max_workers=8):
+        """Returns a batch.Batch() running calls concurrently on up to
+        max_workers threads"""
+        return batch_.Batch(max_workers=max_workers)
+
+    def after_fork(self):
+        """Rebuilds the transports and pools if called in a forked child,
+        then warms up warm_up_connections connections. The auth token and
+        caches are kept.
+
+        Called automatically before the first request sent from a forked
+        child, in which case that request waits for the warm up. Call it
+        from the pre-fork server's post fork hook instead to warm up before
+        the worker accepts any work.
+
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+
+        # dict.setdefault is atomic, concurrent callers get the same lock
+        with self._fork_locks.setdefault(pid, threading.Lock()):
+            if self._pid == pid:
+                # reset by another thread
+                return
+
+            LOG.debug('fork detected, resetting client')
+            self._http_handler.reset()
+            if self.router is not None:
+                self.router.after_fork()
+            if self.governor is not None:
+                self.governor.after_fork()
+            self.resolver.cache.after_fork()
+            for k in list(self._fork_locks):
+                if k != pid:
+                    del self._fork_locks[k]
+
+            # only now other threads may use the transports
+            self._pid = pid
+
+        if self.warm_up_connections:
+            self.warm_up(self.warm_up_connections)
+
+    def warm_up(self, connections=1):
+        """Pre-opens up to connections pooled connections to each API node
+        (requests library only)"""
+        if self.router is not None:
+            base_uris = [n.base_uri for n in self.router.nodes]
+        else:
+            base_uris = [self.base_uri]
+
+        headers = {'Accept': 'application/json'}
+        if self.auth_token:
+            headers['x-auth-token'] = self.auth_token
+
+        for base_uri in base_uris:
+            request = http.Request(
+                uri='{0}/schemas?limit=1'.format(base_uri), headers=headers)
+            self._http_handler.warm_up(request, connections)
+
     def request(self, request):
-        return self._http_handler.request(request)
+        if self._pid != os.getpid():
+            self.after_fork()
+
+        if self.governor is None:
+            return self._route(request)
+
+        error = None
+        start = self.governor.acquire()
+        try:
+            return self._route(request)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.governor.release(start, error)
+
+    def node_stats(self):
+        """Returns a list of per API node statistics dicts"""
+        if self.router is None:
+            return []
+        return self.router.stats()
+
+    def _route(self, request):
+        if self.router is None:
+            return self._http_handler.request(request)
+
+        # request uris are built against self.base_uri
+        path = request.uri[len(self.base_uri):]
+        write = request.method.upper() != 'GET'
+
+        tried = []
+        while True:
+            node = self.router.select(write=write, exclude=tried)
+            tried.append(node)
+            request.uri = node.base_uri + path
+
+            start = time.time()
+            try:
+                response = self._http_handler.request(request)
+            except Exception as e:
+                self.router.report(node, time.time() - start, e)
+                # reads failing to connect are retried on another node
+                if write or isinstance(e, Error) or \
+                        len(tried) >= len(self.router.nodes):
+                    raise
+                LOG.warning('{0} failed on {1}, retrying: {2}'
+                            .format(request, node.base_uri, e))
+                continue
+
+            self.router.report(node, time.time() - start)
+            return response
+
+    def _probe(self, node):
+        request = http.Request(uri='{0}/schemas?limit=1'.format(node.base_uri),
+                               headers={'Accept': 'application/json'})
+        try:
+            self._http_handler.request(request)
+        except Error as e:
+            # the node answered, e.g. with 401
+            return e.http_status_code is not None and \
+                e.http_status_code < 500
+        return True
 
     def authenticate(self, username, password):
         uri = '{0}/users/auth_token'.format(self.base_uri)
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from . import Response, Error, Meta, http, NullHandler
+from .endpoint import CAS_FAILED_ERROR
+
+if sys.version_info[0] >= 3:
+    from urllib.parse import urlparse, parse_qsl, unquote
+    string_types = (str,)
+else:
+    from urlparse import urlparse, parse_qsl
+    from urllib import unquote
+    string_types = (basestring,)
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+# default page size of the SIS API
+DEFAULT_LIMIT = 200
+
+# collections whose objects are identified by name rather than _id
+NAMED_COLLECTIONS = ('schemas', 'hooks', 'hiera', 'users')
+
+
+class EmulatorHandler(http.BaseHTTPHandler):
+
+    """Serves SIS API requests from an in-memory store instead of
+    sending them over the network.
+
+    Supports schemas, entities, hooks, hiera, users and tokens, Mongo-style
+    'q' filters, 'sort', 'fields', 'limit'/'offset' with the x-total-count
+    header, 'cas' conditional updates and the bulk create/update/delete
+    endpoints.
+
+        client = sispy.Client(url='http://sis.emulator',
+                              http_handler=EmulatorHandler())
+
+    Objects are looked up by _id for entities and by name for the other
+    collections. Requests and responses go through a JSON round trip like
+    they would over the network.
+
+    """
+
+    def __init__(self, users=None, latency=0, *args, **kwargs):
+        """
+        args:
+            users: optional dict of username -> password accepted by
+                authentication, any credentials are accepted if None
+            latency: seconds each request sleeps for to simulate
+                network time
+        """
+        super(EmulatorHandler, self).__init__(*args, **kwargs)
+
+        self.users = users
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        # collection name -> OrderedDict of id -> object
+        self._collections = {}
+        self._counter = 0
+        self._last_ts = 0
+
+        # counters
+        self._requests = 0
+        self._server_time = 0.0
+
+    def stats(self):
+        """Returns a dict with the number of requests served and the time
+        spent serving them, excluding the simulated latency"""
+        with self._lock:
+            return {
+                'requests': self._requests,
+                'server_time': self._server_time,
+            }
+
+    def request(self, request):
+        LOG.debug(request)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        start = time.time()
+        try:
+            with self._lock:
+                self._requests += 1
+                result, headers = self._dispatch(request)
+        except _HTTPError as e:
+            response_dict = {'error': e.error, 'code': e.status}
+            raise Error(http_status_code=e.status,
+                        error=e.error,
+                        code=e.status,
+                        response_dict=response_dict,
+                        headers={})
+        finally:
+            with self._lock:
+                self._server_time += time.time() - start
+
+        # detach the result from the store
+        return Response(json.loads(json.dumps(result)), Meta(headers))
+
+    def _dispatch(self, request):
+        uri = urlparse(request.uri)
+        query = dict(parse_qsl(uri.query))
+        for k in ('q', 'cas'):
+            if k in query:
+                query[k] = _loads(query[k], k)
+
+        # strip everything up to /api/v<version>
+        parts = [unquote(p) for p in uri.path.split('/') if p]
+        for i in range(len(parts) - 1):
+            if parts[i] == 'api' and parts[i + 1].startswith('v'):
+                parts = parts[i + 2:]
+                break
+
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if body:
+            body = _loads(body, 'body')
+
+        method = request.method.upper()
+        headers = request.headers or {}
+
+        if parts == ['users', 'auth_token'] and method == 'POST':
+            return self._authenticate(headers), {}
+
+        collection, id = self._route(parts)
+
+        if method == 'GET' and id is None:
+            return self._fetch(collection, query)
+        elif method == 'GET':
+            return self._project(self._get(collection, id), query), {}
+        elif method == 'POST' and id is None:
+            if isinstance(body, list):
+                return self._bulk(body, lambda item:
+                                  self._create(collection, item)), {}
+            return self._create(collection, body), {}
+        elif method == 'PUT' and id is None:
+            return self._update_bulk(collection, body, query), {}
+        elif method == 'PUT':
+            return self._update(collection, id, body, query.get('cas')), {}
+        elif method == 'DELETE' and id is None:
+            return self._delete_bulk(collection, query), {}
+        elif method == 'DELETE':
+            return self._delete(collection, id), {}
+
+        raise _HTTPError(405, 'Method not allowed')
+
+    def _route(self, parts):
+        """Returns the (collection name, id) addressed by path parts"""
+        if len(parts) in (1, 2) and parts[0] in NAMED_COLLECTIONS:
+            return parts[0], (parts[1] if len(parts) == 2 else None)
+
+        if len(parts) in (2, 3) and parts[0] == 'entities':
+            if parts[1] not in self._collection('schemas'):
+                raise _HTTPError(404, 'Unknown schema {0}'.format(parts[1]))
+            return ('entities/{0}'.format(parts[1]),
+                    parts[2] if len(parts) == 3 else None)
+
+        if len(parts) in (3, 4) and parts[0] == 'users' and \
+                parts[2] == 'tokens':
+            if parts[1] not in self._collection('users'):
+                raise _HTTPError(404, 'Unknown user {0}'.format(parts[1]))
+            return ('users/{0}/tokens'.format(parts[1]),
+                    parts[3] if len(parts) == 4 else None)
+
+        raise _HTTPError(404, 'Not found: /{0}'.format('/'.join(parts)))
+
+    def _collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = OrderedDict()
+        return self._collections[name]
+
+    def _id_field(self, collection):
+        if collection.startswith('entities/'):
+            return '_id'
+        return 'name'
+
+    def _now(self):
+        # strictly increasing timestamps in ms, keeps (_updated, _id)
+        # ordering of writes
+        self._last_ts = max(int(time.time() * 1000), self._last_ts + 1)
+        return self._last_ts
+
+    def _new_id(self):
+        self._counter += 1
+        return '{0:08x}{1:016x}'.format(int(time.time()), self._counter)
+
+    def _authenticate(self, headers):
+        auth = None
+        for k in headers:
+            if k.lower() == 'authorization':
+                auth = headers[k]
+        if not auth or not auth.startswith('Basic '):
+            raise _HTTPError(401, 'Unauthorized')
+        try:
+            creds = base64.b64decode(auth[len('Basic '):].encode('utf-8'))
+            username, password = creds.decode('utf-8').split(':', 1)
+        except (ValueError, TypeError, binascii.Error):
+            raise _HTTPError(401, 'Unauthorized')
+
+        if self.users is not None and self.users.get(username) != password:
+            raise _HTTPError(401, 'Unauthorized')
+
+        users = self._collection('users')
+        if username not in users:
+            self._create('users', {'name': username})
+
+        token = {
+            'name': '{0:032x}'.format(self._counter + 1),
+            'username': username,
+            'desc': 'temporary token',
+        }
+        return self._create('users/{0}/tokens'.format(username), token)
+
+    def _fetch(self, collection, query):
+        q = query.get('q') or {}
+        if not isinstance(q, dict):
+            raise _HTTPError(400, 'q must be an object')
+
+        items = [obj for obj in self._candidates(collection, q)
+                 if _match(obj, q)]
+
+        if query.get('sort'):
+            items = _sort(items, query['sort'])
+
+        try:
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit', DEFAULT_LIMIT))
+        except ValueError:
+            raise _HTTPError(400, 'limit and offset must be integers')
+
+        page = [self._project(obj, query)
+                for obj in items[offset:offset + limit]]
+        return page, {'x-total-count': str(len(items))}
+
+    def _candidates(self, collection, q):
+        """Uses the id index when the filter selects by id"""
+        objs = self._collection(collection)
+        cond = q.get(self._id_field(collection))
+
+        if isinstance(cond, dict) and list(cond.keys()) == ['$in'] and \
+                isinstance(cond['$in'], list):
+            ids = cond['$in']
+        elif cond is not None and not isinstance(cond, (dict, list)):
+            ids = [cond]
+        else:
+            return list(objs.values())
+
+        return [objs[id] for id in ids
+                if isinstance(id, string_types) and id in objs]
+
+    def _project(self, obj, query):
+        fields = query.get('fields')
+        if not fields:
+            return obj
+        keep = set(f.split('.')[0] for f in re.split('[, ]+', fields) if f)
+        keep.add('_id')
+        return dict((k, v) for k, v in obj.items() if k in keep)
+
+    def _get(self, collection, id):
+        objs = self._collection(collection)
+        if id not in objs:
+            raise _HTTPError(404, '{0} {1} not found'.format(collection, id))
+        return objs[id]
+
+    def _create(self, collection, content):
+        if not isinstance(content, dict):
+            raise _HTTPError(400, 'content must be an object')
+
+        id_field = self._id_field(collection)
+        objs = self._collection(collection)
+
+        if collection == 'schemas':
+            if not content.get('name') or \
+                    not isinstance(content.get('definition'), dict):
+                raise _HTTPError(400, 'schema requires a name and '
+                                      'a definition')
+
+        obj = dict(content)
+        now = self._now()
+        obj['_id'] = self._new_id()
+        obj['_created'] = now
+        obj['_updated'] = now
+        obj['__v'] = 0
+        obj.setdefault('_sis', {})
+
+        id = obj.get(id_field)
+        if not id:
+            raise _HTTPError(400, '{0} is required'.format(id_field))
+        if id in objs:
+            raise _HTTPError(409, '{0} {1} already exists'
+                             .format(collection, id))
+
+        objs[id] = obj
+        return obj
+
+    def _update(self, collection, id, content, cas=None):
+        if not isinstance(content, dict):
+            raise _HTTPError(400, 'content must be an object')
+
+        obj = self._get(collection, id)
+
+        if cas is not None:
+            for path, expected in cas.items():
+                values = _values(obj, path)
+                actual = values[0] if values else None
+                if actual != expected:
+                    raise _HTTPError(400, CAS_FAILED_ERROR)
+
+        id_field = self._id_field(collection)
+        if content.get(id_field, id) != id:
+            raise _HTTPError(400, '{0} cannot be changed'.format(id_field))
+
+        _merge(obj, dict((k, v) for k, v in content.items()
+                         if k not in ('_id', '_created', '_updated', '__v')))
+        obj['_updated'] = self._now()
+        obj['__v'] += 1
+        return obj
+
+    def _update_bulk(self, collection, content, query):
+        if isinstance(content, list):
+            id_field = self._id_field(collection)
+
+            def update(item):
+                if not isinstance(item, dict) or id_field not in item:
+                    raise _HTTPError(400, '{0} is required'.format(id_field))
+                return self._update(collection, item[id_field], item,
+                                    query.get('cas'))
+
+            return self._bulk(content, update)
+
+        q = query.get('q')
+        if not isinstance(q, dict):
+            raise _HTTPError(400, 'a query is required')
+
+        ids = [obj[self._id_field(collection)]
+               for obj in self._candidates(collection, q) if _match(obj, q)]
+        return self._bulk(ids, lambda id: self._update(
+            collection, id, content, query.get('cas')))
+
+    def _delete(self, collection, id):
+        obj = self._get(collection, id)
+        del self._collection(collection)[id]
+
+        if collection == 'schemas':
+            self._collections.pop('entities/{0}'.format(id), None)
+        elif collection == 'users':
+            self._collections.pop('users/{0}/tokens'.format(id), None)
+        return obj
+
+    def _delete_bulk(self, collection, query):
+        q = query.get('q')
+        if not isinstance(q, dict) or not q:
+            raise _HTTPError(400, 'a non empty query is required')
+
+        ids = [obj[self._id_field(collection)]
+               for obj in self._candidates(collection, q) if _match(obj, q)]
+        return self._bulk(ids, lambda id: self._delete(collection, id))
+
+    def _bulk(self, items, fn):
+        result = {'success': [], 'errors': []}
+        for item in items:
+            try:
+                result['success'].append(fn(item))
+            except _HTTPError as e:
+                result['errors'].append({'error': e.error, 'code': e.status,
+                                         'value': item})
+        return result
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, error):
+        super(_HTTPError, self).__init__(error)
+        self.status = status
+        self.error = error
+
+
+def _loads(s, name):
+    try:
+        return json.loads(s)
+    except ValueError:
+        raise _HTTPError(400, '{0} is not valid JSON'.format(name))
+
+
+def _merge(obj, changes):
+    """Applies changes to obj in place, merging nested objects and
+    removing fields set to None"""
+    for k, v in changes.items():
+        if v is None:
+            obj.pop(k, None)
+        elif isinstance(v, dict) and isinstance(obj.get(k), dict):
+            _merge(obj[k], v)
+        else:
+            obj[k] = v
+
+
+def _values(doc, path):
+    """Returns the values at a dotted path, descending into arrays of sub
+    documents, an empty list if the path is missing"""
+    values = [doc]
+    for key in path.split('.'):
+        found = []
+        for v in values:
+            if isinstance(v, dict):
+                if key in v:
+                    found.append(v[key])
+            elif isinstance(v, list):
+                found.extend(e[key] for e in v
+                             if isinstance(e, dict) and key in e)
+        values = found
+    return values
+
+
+def _expand(values):
+    """Values and the elements of array values, for comparisons"""
+    expanded = []
+    for v in values:
+        if isinstance(v, list):
+            expanded.extend(v)
+        expanded.append(v)
+    return expanded
+
+
+def _match(doc, q):
+    for key, cond in q.items():
+        if key == '$and':
+            if not all(_match(doc, sub) for sub in cond):
+                return False
+        elif key == '$or':
+            if not any(_match(doc, sub) for sub in cond):
+                return False
+        elif key == '$nor':
+            if any(_match(doc, sub) for sub in cond):
+                return False
+        elif key.startswith('$'):
+            raise _HTTPError(400, 'Unsupported operator {0}'.format(key))
+        elif not _match_values(_values(doc, key), cond):
+            return False
+    return True
+
+
+def _match_values(values, cond):
+    if isinstance(cond, dict) and cond and \
+            all(k.startswith('$') for k in cond):
+        return all(_match_op(values, op, arg, cond)
+                   for op, arg in cond.items())
+    return _eq(values, cond)
+
+
+def _eq(values, target):
+    if not values:
+        # a missing field matches null
+        return target is None
+    return any(v == target for v in _expand(values))
+
+
+def _compare(values, fn):
+    for v in _expand(values):
+        try:
+            if v is not None and fn(v):
+                return True
+        except TypeError:
+            pass
+    return False
+
+
+def _match_op(values, op, arg, cond):
+    if op == '$eq':
+        return _eq(values, arg)
+    elif op == '$ne':
+        return not _eq(values, arg)
+    elif op == '$gt':
+        return _compare(values, lambda v: v > arg)
+    elif op == '$gte':
+        return _compare(values, lambda v: v >= arg)
+    elif op == '$lt':
+        return _compare(values, lambda v: v < arg)
+    elif op == '$lte':
+        return _compare(values, lambda v: v <= arg)
+    elif op == '$in':
+        return any(_eq(values, a) for a in arg)
+    elif op == '$nin':
+        return not any(_eq(values, a) for a in arg)
+    elif op == '$exists':
+        return bool(values) == bool(arg)
+    elif op == '$regex':
+        flags = 0
+        if 'i' in cond.get('$options', ''):
+            flags |= re.IGNORECASE
+        regex = re.compile(arg, flags)
+        return any(isinstance(v, string_types) and regex.search(v)
+                   for v in _expand(values))
+    elif op == '$options':
+        return True
+    elif op == '$all':
+        return all(_eq(values, a) for a in arg)
+    elif op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    elif op == '$not':
+        return not _match_values(values, arg)
+
+    raise _HTTPError(400, 'Unsupported operator {0}'.format(op))
+
+
+def _sort(items, sort):
+    """Sorts items by a comma or space separated list of fields,
+    descending if prefixed with '-'"""
+    for field in reversed([f for f in re.split('[, ]+', sort) if f]):
+        reverse = field.startswith('-')
+        field = field.lstrip('-+')
+
+        def key(obj):
+            values = _values(obj, field)
+            value = values[0] if values else None
+            # missing values sort first
+            return (value is not None, value)
+
+        try:
+            items = sorted(items, key=key, reverse=reverse)
+        except TypeError:
+            items = sorted(items, key=lambda obj: str(key(obj)),
+                           reverse=reverse)
+    return items
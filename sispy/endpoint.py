@@ -2,12 +2,16 @@
 
 import logging
 import json
+import time
 
-from . import Error, Response, http, NullHandler
+from . import Error, ConflictError, Response, http, writer, NullHandler
 
 LOG = logging.getLogger(__name__)
 LOG.addHandler(NullHandler())
 
+# error returned by the server with a 400 when a cas condition fails
+CAS_FAILED_ERROR = 'CAS Failed'
+
 
 class Endpoint(object):
 
@@ -17,28 +21,42 @@ class Endpoint(object):
         self.endpoint = endpoint
         self.client = client
 
-    def fetch_page(self, query=None):
+    def fetch_page(self, query=None, fields=None):
         """Returns a Response() list-like object
 
         Response()._meta.total_count is the total number of items
 
+        fields is an optional list of fields to return
+
         """
-        return self._get(query=query)
+        return self._get(query=self._with_fields(query, fields))
 
-    def fetch_all(self, query=None):
+    def fetch_all(self, query=None, fields=None, resolve=None):
         """Calls fetch_page() multiple times to retrieve all items,
         returns a Response() list-like object of items fetched.
 
         Response._meta.headers is set to headers of the last HTTP request
 
+        fields is an optional list of fields to return
+
+        resolve is an optional list of reference fields (dotted paths) to
+        replace by the referenced entities, page by page, see
+        join.Resolver.resolve(). Entities endpoints only.
+
         """    
         if not query:
             query = {}
 
+        if resolve:
+            schema_name = self._get_schema_name()
+
         results = []
         while True:
-            response = self.fetch_page(query)
-            results.extend(list(response))
+            response = self.fetch_page(query, fields)
+            page = list(response)
+            if resolve:
+                self.client.resolve(schema_name, page, resolve)
+            results.extend(page)
             if len(results) >= response._meta.total_count:
                 break
             query['offset'] = len(results)
@@ -46,9 +64,121 @@ class Endpoint(object):
         response._result = results
         return response
 
-    def get(self, id):
-        """API GET """
-        return self._get(id)
+    def watch(self, query=None, interval=60, fields=None, since=None,
+              delete_interval=600, callback=None, page_size=200):
+        """Polls for items created, updated or deleted, returns a generator
+        yielding (event, item) tuples where event is one of 'created',
+        'updated' or 'deleted'. Items of 'deleted' events only contain _id.
+
+        If callback is given callback(event, item) is called for each event
+        instead and the call blocks.
+
+        args:
+            query: optional dict, only its 'q' filter is used
+            interval: seconds to wait between polls
+            fields: optional list of fields to fetch for changed items
+            since: optional (_updated, _id) tuple to start watching from,
+                defaults to the most recent change
+            delete_interval: seconds between id-only diffs used to detect
+                deleted items, None disables deletion detection
+            page_size: number of items fetched per request
+
+        Each poll only fetches items with a greater (_updated, _id) than
+        the newest item seen so far. Results are paged by key rather than
+        by offset so that concurrent changes do not shift pages.
+
+        """
+        events = self._watch(query, interval, fields, since, delete_interval,
+                             page_size)
+        if callback is None:
+            return events
+
+        for event, item in events:
+            callback(event, item)
+
+    def _watch(self, query, interval, fields, since, delete_interval,
+               page_size):
+        q = (query or {}).get('q') or {}
+
+        known = None
+        if delete_interval is not None:
+            known = self._fetch_ids(q, page_size)
+            last_diff = time.time()
+
+        mark = since
+        if mark is None:
+            newest = self.fetch_page({'q': q, 'sort': '-_updated,-_id',
+                                      'limit': 1},
+                                     fields=['_id', '_updated'])
+            if len(newest):
+                mark = (newest[0]['_updated'], newest[0]['_id'])
+
+        if fields:
+            fields = sorted(set(fields) | set(['_id', '_created', '_updated']))
+
+        while True:
+            # items created after the previous poll
+            poll_mark = mark
+            while True:
+                changes_query = {'q': q, 'sort': '_updated,_id',
+                                 'limit': page_size}
+                if mark is not None:
+                    changes_query['q'] = {'$and': [q, {'$or': [
+                        {'_updated': {'$gt': mark[0]}},
+                        {'_updated': mark[0], '_id': {'$gt': mark[1]}},
+                    ]}]}
+
+                page = sorted(self.fetch_page(changes_query, fields),
+                              key=lambda item: (item['_updated'],
+                                                item['_id']))
+                for item in page:
+                    if poll_mark is None or \
+                            item.get('_created', 0) > poll_mark[0]:
+                        event = 'created'
+                    else:
+                        event = 'updated'
+                    if known is not None:
+                        known.add(item['_id'])
+                    yield event, item
+
+                if page:
+                    mark = (page[-1]['_updated'], page[-1]['_id'])
+                if len(page) < page_size:
+                    break
+
+            if known is not None and \
+                    time.time() - last_diff >= delete_interval:
+                current = self._fetch_ids(q, page_size)
+                last_diff = time.time()
+                for id in sorted(known - current):
+                    yield 'deleted', {'_id': id}
+                known = current
+
+            time.sleep(interval)
+
+    def _fetch_ids(self, q, page_size):
+        """Returns the set of ids of the items matching q, paged by _id"""
+        ids = set()
+        last = None
+        while True:
+            page_q = q
+            if last is not None:
+                page_q = {'$and': [q, {'_id': {'$gt': last}}]}
+            page = self.fetch_page({'q': page_q, 'sort': '_id',
+                                    'limit': page_size}, fields=['_id'])
+            page_ids = [item['_id'] for item in page]
+            ids.update(page_ids)
+            if len(page_ids) < page_size:
+                return ids
+            last = max(page_ids)
+
+    def get(self, id, fields=None):
+        """API GET
+
+        fields is an optional list of fields to return
+
+        """
+        return self._get(id, self._with_fields(None, fields))
 
     def create(self, content):
         """API POST """
@@ -61,8 +191,15 @@ class Endpoint(object):
 
         return self.client.request(request)
 
-    def update(self, id, content, query=None):
-        """API PUT """
+    def update(self, id, content, query=None, expect=None):
+        """API PUT
+
+        expect is an optional dict of field values the stored object must
+        match for the update to be applied (compare-and-swap), ConflictError
+        is raised otherwise.
+
+        """
+        query = self._with_cas(query, expect)
 
         headers = self._get_headers(add_content=True)
         request = http.Request(uri=self._get_uri(id, query),
@@ -70,11 +207,79 @@ class Endpoint(object):
                                body=json.dumps(content),
                                headers=headers)
 
-        return self.client.request(request)
+        try:
+            return self.client.request(request)
+        except Error as e:
+            if expect is None or not _is_cas_conflict(e):
+                raise
+            raise ConflictError(error=e.error,
+                                http_status_code=e.http_status_code,
+                                code=e.code,
+                                response_dict=e.response_dict,
+                                headers=e.headers,
+                                current=self._get_current(id))
+
+    def update_with_retry(self, id, content, expect, merge, max_retries=3):
+        """Conditional update retried on conflicts.
+
+        On ConflictError merge(current, content) is called with the stored
+        object and must return the content to retry with, expect is
+        refreshed from the stored object. ConflictError is re-raised once
+        max_retries is exhausted.
+
+        """
+        for attempt in range(max_retries + 1):
+            try:
+                return self.update(id, content, expect=expect)
+            except ConflictError as e:
+                if attempt == max_retries or e.current is None:
+                    raise
+                current = e.current.to_dict()
+                content = merge(current, content)
+                expect = dict((k, _lookup(current, k)) for k in expect)
+
+    def diff_update(self, original, modified, id=None, expect=None):
+        """Updates the object with the fields that differ between original
+        and modified only.
+
+        Nested dicts (e.g. _sis) are compared field by field, fields
+        missing from modified are set to None. Other top level fields
+        starting with '_' are maintained by the server and ignored.
+
+        id defaults to the _id (or name) of the object, sispy.Error is
+        raised if there is none. expect is passed to update(). Returns None
+        without sending a request if nothing changed.
+
+        """
+        if isinstance(original, Response):
+            original = original.to_dict()
+        if isinstance(modified, Response):
+            modified = modified.to_dict()
+
+        delta = _diff(original, modified, top_level=True)
+        if not delta:
+            return None
+
+        if id is None:
+            id = modified.get('_id', original.get('_id'))
+        if id is None:
+            id = modified.get('name', original.get('name'))
+        if id is None:
+            err_msg = 'id is required if the object has no _id or name'
+            raise Error(http_status_code=400,
+                        error=err_msg,
+                        code=0,
+                        response_dict={})
 
-    def update_bulk(self, content, query=None):
+        return self.update(id, delta, expect=expect)
+
+    def update_bulk(self, content, query=None, expect=None):
         """API Bulk update.
 
+        expect is an optional dict of field values the stored objects must
+        match for the update to be applied (compare-and-swap), objects that
+        do not match are reported in 'errors'.
+
         Returns: a Response dict-like object in the form of
         {
             'errors': [<items>],
@@ -84,6 +289,7 @@ class Endpoint(object):
 
         if isinstance(content, list):
             # Handle update if we're provided a list of changes
+            query = self._with_cas(query, expect)
             headers = self._get_headers(add_content=True)
             request = http.Request(uri=self._get_uri(query=query),
                                    method='PUT',
@@ -101,6 +307,7 @@ class Endpoint(object):
                             code=0,
                             response_dict={})
 
+            query = self._with_cas(query, expect)
             headers = self._get_headers(add_content=True)
             request = http.Request(uri=self._get_uri(query=query),
                                    method='put',
@@ -161,6 +368,17 @@ class Endpoint(object):
 
         return self.client.request(request)
 
+    def writer(self, **kwargs):
+        """Returns a writer.BulkWriter() buffering single item
+        create/update/delete operations into bulk requests.
+
+        kwargs are passed to writer.BulkWriter(). Entities endpoints only,
+        operations are keyed by _id.
+
+        """
+        self._get_schema_name()
+        return writer.BulkWriter(self, **kwargs)
+
     def _get(self, obj=None, query=None):
         headers = self._get_headers(add_content=True)
         request = http.Request(uri = self._get_uri(obj, query),
@@ -168,6 +386,34 @@ class Endpoint(object):
         
         return self.client.request(request)
 
+    def _get_schema_name(self):
+        prefix = 'entities/'
+        if not self.endpoint.startswith(prefix):
+            raise Error('{0} is not an entities endpoint'.format(self.endpoint))
+        return self.endpoint[len(prefix):]
+
+    def _with_fields(self, query, fields):
+        if not fields:
+            return query
+        query = dict(query or {})
+        if isinstance(fields, (list, tuple, set)):
+            fields = ','.join(fields)
+        query['fields'] = fields
+        return query
+
+    def _with_cas(self, query, expect):
+        if expect is None:
+            return query
+        query = dict(query or {})
+        query['cas'] = expect
+        return query
+
+    def _get_current(self, id):
+        try:
+            return self.get(id)
+        except Error:
+            return None
+
     def _get_headers(self, add_content):
         headers = {
             'Accept': 'application/json'
@@ -202,3 +448,42 @@ class Endpoint(object):
                                   path_str, query_str)
         return resp
 
+
+def _is_cas_conflict(e):
+    return e.http_status_code == 400 and \
+        str(e.error).strip() == CAS_FAILED_ERROR
+
+
+def _lookup(obj, path):
+    """Returns the value of a dotted path e.g. '_sis.owner' in obj,
+    None if not present"""
+    for key in path.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def _diff(original, modified, top_level=False):
+    """Returns a dict of the fields of modified that differ from original,
+    recursing into nested dicts"""
+    delta = {}
+    for k in modified:
+        if top_level and k.startswith('_') and k != '_sis':
+            continue
+        if k not in original:
+            delta[k] = modified[k]
+        elif original[k] != modified[k]:
+            if isinstance(original[k], dict) and \
+                    isinstance(modified[k], dict):
+                delta[k] = _diff(original[k], modified[k])
+            else:
+                delta[k] = modified[k]
+
+    for k in original:
+        if top_level and k.startswith('_') and k != '_sis':
+            continue
+        if k not in modified:
+            delta[k] = None
+
+    return delta
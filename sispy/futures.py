@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from . import Error, NullHandler
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+
+class FutureTimeout(Error):
+    """Raised when a Future is not resolved within the given timeout"""
+
+    def __init__(self, error='operation timed out'):
+        super(FutureTimeout, self).__init__(error=error)
+
+
+class Future(object):
+
+    """Result of an operation that completes in another thread.
+
+    Minimal stdlib-only counterpart of concurrent.futures.Future which is
+    not available on all the python versions supported by the client.
+
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Returns True if the future has been resolved"""
+        with self._condition:
+            return self._done
+
+    def result(self, timeout=None):
+        """Blocks until the future is resolved and returns its result,
+        re-raises the exception the operation failed with if any.
+
+        """
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Blocks until the future is resolved and returns the exception
+        the operation failed with or None.
+
+        """
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise FutureTimeout()
+            return self._exception
+
+    def add_done_callback(self, fn):
+        """Calls fn(future) once the future is resolved, immediately
+        if it already is.
+
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exception):
+        self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        with self._condition:
+            if self._done:
+                return
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notify_all()
+
+        for fn in callbacks:
+            self._invoke(fn)
+
+    def _invoke(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            LOG.exception('exception in future callback {0}'.format(fn))
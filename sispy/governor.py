@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+import weakref
+from email.utils import parsedate_tz, mktime_tz
+
+from . import Error, NullHandler
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+# http status codes signalling that the server is overloaded
+OVERLOAD_STATUS_CODES = (429, 502, 503, 504)
+
+# shared governors by server
+_governors = {}
+_governors_lock = threading.Lock()
+
+# all governors, reset in forked children
+_instances = weakref.WeakSet()
+
+
+def _reset_registry():
+    global _governors_lock
+    # the lock may have been held by another thread at fork time
+    _governors_lock = threading.Lock()
+    for governor in list(_instances):
+        governor.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_registry)
+
+
+def get_governor(server, **kwargs):
+    """Returns the Governor() shared by all clients of server, creating it
+    with kwargs on first use.
+
+    """
+    with _governors_lock:
+        if server not in _governors:
+            _governors[server] = Governor(**kwargs)
+        return _governors[server]
+
+
+class Governor(object):
+
+    """Client side concurrency and rate governor.
+
+    Every request acquires a slot before it is sent and releases it with
+    the outcome once it completes:
+        - at most .limit requests are in flight, .limit grows additively
+          (by about one per .limit successful requests) and shrinks
+          multiplicatively on overload responses (429/5xx), connection
+          errors or rising latency (AIMD). Latency is rising when its
+          EWMA exceeds latency_factor times the lowest EWMA seen over the
+          last baseline_window seconds, or target_latency if set
+        - if rate is set a token bucket caps the number of requests
+          started per second, allowing bursts of up to burst requests
+        - a Retry-After header on an overload response pauses all
+          requests for the given time
+
+    """
+
+    def __init__(self, max_concurrency=32, min_concurrency=1,
+                 initial_concurrency=4, rate=None, burst=None,
+                 target_latency=None, latency_factor=2.0,
+                 baseline_window=60, latency_floor=0.01, backoff=0.5):
+        """
+        args:
+            max_concurrency: upper bound of the concurrency limit
+            min_concurrency: lower bound of the concurrency limit
+            initial_concurrency: starting concurrency limit
+            rate: maximum number of requests started per second or None
+            burst: token bucket size, defaults to rate
+            target_latency: seconds, optional absolute latency above which
+                requests shrink the limit
+            latency_factor: the limit shrinks when the latency EWMA exceeds
+                the baseline (lowest EWMA seen) by this factor
+            baseline_window: seconds after which the baseline is reset to
+                the current EWMA, to follow lasting latency changes
+            latency_floor: seconds, latencies below are never considered
+                rising
+            backoff: factor the limit is multiplied by on overload
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.target_latency = target_latency
+        self.latency_factor = latency_factor
+        self.baseline_window = baseline_window
+        self.latency_floor = latency_floor
+        self.backoff = backoff
+
+        self.limit = float(max(min_concurrency,
+                               min(initial_concurrency, max_concurrency)))
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._tokens = self.burst
+        self._refill_ts = time.time()
+        self._paused_until = 0
+        self._last_backoff = 0
+        self._baseline_ts = 0
+
+        # counters
+        self._requests = 0
+        self._overloads = 0
+
+        _instances.add(self)
+
+    def acquire(self):
+        """Blocks until a request may be sent, returns the start time to
+        be passed to release()
+
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                wait = self._paused_until - now
+                if wait <= 0 and self.in_flight >= int(self.limit):
+                    # woken up by release()
+                    wait = None
+                elif wait <= 0 and self.rate:
+                    self._refill(now)
+                    if self._tokens < 1:
+                        wait = (1 - self._tokens) / self.rate
+                if wait is not None and wait <= 0:
+                    break
+                self._cond.wait(wait)
+
+            if self.rate:
+                self._tokens -= 1
+            self.in_flight += 1
+            self._requests += 1
+            return time.time()
+
+    def release(self, start, error=None):
+        """Releases a slot acquired at start, error is the exception the
+        request failed with if any
+
+        """
+        now = time.time()
+        latency = now - start
+
+        with self._cond:
+            self.in_flight -= 1
+
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            if self.baseline is None or self.latency < self.baseline or \
+                    now - self._baseline_ts >= self.baseline_window:
+                self.baseline = self.latency
+                self._baseline_ts = now
+
+            if error is not None and _is_overload(error):
+                self._overloads += 1
+                retry_after = _retry_after(error, now)
+                if retry_after:
+                    self._paused_until = max(self._paused_until,
+                                             now + retry_after)
+                self._decrease(now)
+            elif self._latency_rising(latency):
+                self._decrease(now)
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1.0 / self.limit)
+
+            self._cond.notify_all()
+
+    def after_fork(self):
+        """Resets the state inherited from the parent process if called in
+        a forked child, keeping the learned concurrency limit.
+        Called in the child at fork time where os.register_at_fork is
+        available"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        # published last, other threads then use the new condition
+        self._pid = pid
+
+    def stats(self):
+        """Returns a dict with the governor's current state"""
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'latency': self.latency,
+                'baseline': self.baseline,
+                'requests': self._requests,
+                'overloads': self._overloads,
+                'paused_for': max(0, self._paused_until - time.time()),
+            }
+
+    def _latency_rising(self, latency):
+        if self.target_latency and latency > self.target_latency:
+            return True
+        return self.latency > self.latency_floor and \
+            self.latency > self.latency_factor * self.baseline
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._refill_ts) * self.rate)
+        self._refill_ts = now
+
+    def _decrease(self, now):
+        # back off at most once per round trip, requests in flight at the
+        # time of the first failure report the same overload
+        if now - self._last_backoff < (self.latency or 0):
+            return
+        self._last_backoff = now
+        self.limit = max(self.min_concurrency, self.limit * self.backoff)
+        LOG.debug('concurrency limit decreased to {0:.2f}'.format(self.limit))
+
+
+def _is_overload(error):
+    if isinstance(error, Error):
+        return error.http_status_code in OVERLOAD_STATUS_CODES
+    # connection errors and timeouts
+    return True
+
+
+def _retry_after(error, now):
+    """Returns the number of seconds in the Retry-After header of error
+    or None"""
+    headers = getattr(error, 'headers', None) or {}
+    value = None
+    for k in headers:
+        if k.lower() == 'retry-after':
+            value = headers[k]
+            break
+    if value is None:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - now)
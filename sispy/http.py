@@ -3,6 +3,7 @@
 import logging
 import sys
 import json
+import threading
 
 from . import Response, Error, Meta, NullHandler
 
@@ -78,6 +79,21 @@ def get_handler(http_keep_alive=True):
         return RequestsHandler(http_keep_alive=http_keep_alive)
 
 
+def _headers_to_dict(info):
+    """Returns headers of a stdlib response info() object as a dict"""
+    # py3
+    if sys.version_info[0] >= 3:
+        # python2.6 does not support dict comprehensions
+        d = {}
+        for k, v in info.items():
+            d[k] = v
+        return d
+
+    # py2
+    else:
+        return info.dict
+
+
 class Request(object):
 
     """HTTP request proxy"""
@@ -105,6 +121,16 @@ class BaseHTTPHandler(object):
     def request(self, request):
         raise NotImplementedError
 
+    def reset(self):
+        """Drops connections inherited from the parent process,
+        called in a forked child before it sends any request"""
+        pass
+
+    def warm_up(self, request, connections=1):
+        """Opens up to connections pooled connections by sending request
+        concurrently, errors are ignored"""
+        pass
+
 
 class StdLibHandler(BaseHTTPHandler):
 
@@ -144,6 +170,7 @@ class StdLibHandler(BaseHTTPHandler):
         except stdlib_HTTPError as e:
             # read response
             response_str = e.read().decode('utf-8')
+            headers = _headers_to_dict(e.info())
 
             # decode response, trap non-json responses
             try:
@@ -151,7 +178,8 @@ class StdLibHandler(BaseHTTPHandler):
             except ValueError:
                 raise Error(http_status_code=e.code,
                             error=('Failed to decode JSON from the response: {0}'
-                                   .format(response_str[:256].encode('utf-8'))))
+                                   .format(response_str[:256].encode('utf-8'))),
+                            headers=headers)
                                                             
             code = response_dict.get('code')
 
@@ -164,7 +192,8 @@ class StdLibHandler(BaseHTTPHandler):
             raise Error(http_status_code=e.code,
                         error=error,
                         code=code,
-                        response_dict=response_dict)
+                        response_dict=response_dict,
+                        headers=headers)
 
         # read response
         response_str = response.read().decode('utf-8')
@@ -178,17 +207,7 @@ class StdLibHandler(BaseHTTPHandler):
                                .format(response_str[:256].encode('utf-8'))))
 
         # build meta with headers as a dict
-        # py3
-        if sys.version_info[0] >= 3:
-            # python2.6 does not support dict comprehensions
-            d = {}
-            for k, v in response.info().items():
-                d[k] = v
-            meta = Meta(d)
-
-        # py2
-        else:
-            meta = Meta(response.info().dict)
+        meta = Meta(_headers_to_dict(response.info()))
 
         # return Response object    
         return Response(result, meta)
@@ -196,15 +215,59 @@ class StdLibHandler(BaseHTTPHandler):
 
 class RequestsHandler(BaseHTTPHandler):
 
-    """Handles HTTP using requests library"""          
+    """Handles HTTP using requests library
+
+    Safe for concurrent use: each thread uses its own Session (which is not
+    thread safe) while all the sessions share one connection pool.
+
+    """          
 
-    def __init__(self, http_keep_alive=True, *args, **kwargs):
+    def __init__(self, http_keep_alive=True, pool_maxsize=32,
+                 *args, **kwargs):
         super(RequestsHandler, self).__init__(*args, **kwargs)
 
         self.http_keep_alive = http_keep_alive
+        self.pool_maxsize = pool_maxsize
+
+        self._new_pool()
+
+    def reset(self):
+        # do not close the inherited pool, its sockets are shared with
+        # the parent process
+        self._new_pool()
+
+    def _new_pool(self):
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.pool_maxsize)
+        self._local = threading.local()
+
+    def _get_session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._local.session = session
+        return session
+
+    def warm_up(self, request, connections=1):
+        if not self.http_keep_alive:
+            return
+
+        def send():
+            try:
+                self.request(Request(uri=request.uri,
+                                     method=request.method,
+                                     headers=dict(request.headers or {})))
+            except Exception:
+                LOG.debug('warm up request failed', exc_info=True)
+
+        threads = [threading.Thread(target=send) for _ in range(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
 
-        self._session = requests.Session()
-        
     def request(self, request):
         LOG.debug(request)
 
@@ -215,13 +278,14 @@ class RequestsHandler(BaseHTTPHandler):
         # prepare request
         req = requests.Request(request.method, request.uri, 
                                data=request.body, headers=request.headers)
-        prepped = self._session.prepare_request(req)
+        session = self._get_session()
+        prepped = session.prepare_request(req)
 
         # send request
         # stream=True immediately download the response 
         # content(default is False)
         # verify=False do not verify SSL cert
-        response = self._session.send(prepped, stream=True, verify=False)
+        response = session.send(prepped, stream=True, verify=False)
 
         # Explicitly set response encoding to 'utf-8'. This fixes long responses issue.
         # This is consistent with StdLib encoding handling.
@@ -235,7 +299,8 @@ class RequestsHandler(BaseHTTPHandler):
         except ValueError:
             raise Error(http_status_code=response.status_code,
                         error=('Failed to decode JSON from the response: {0}'
-                               .format(response.text[:256].encode('utf-8'))))
+                               .format(response.text[:256].encode('utf-8'))),
+                        headers=response.headers)
 
         # raise Error if we got http status code >= 400
         if response.status_code >= 400:
@@ -246,7 +311,8 @@ class RequestsHandler(BaseHTTPHandler):
             raise Error(http_status_code=response.status_code,
                         error=error,
                         code=code,
-                        response_dict=response_dict)
+                        response_dict=response_dict,
+                        headers=response.headers)
 
         # create Meta
         meta = Meta(response.headers)
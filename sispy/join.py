@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+from . import Error, Response, NullHandler
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+# all caches, reset in forked children
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for cache in list(_instances):
+        cache.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LRUCache(object):
+
+    """Thread safe bounded mapping evicting the least recently used items"""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+
+        self._data = OrderedDict()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+        _instances.add(self)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def after_fork(self):
+        """Replaces the lock inherited from the parent process if called in
+        a forked child, keeping the cached items.
+        Called in the child at fork time where os.register_at_fork is
+        available"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._lock = threading.Lock()
+        # published last, other threads then use the new lock
+        self._pid = pid
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class Resolver(object):
+
+    """Resolves references to other schemas' entities (client-side join).
+
+    For each path the referenced ids of all the items are collected,
+    deduplicated and fetched with chunked '$in' queries running
+    concurrently. The references are then replaced in place by copies of
+    the referenced entities. Fetched entities are kept in cache (an
+    LRUCache keyed by (schema name, _id)) across calls.
+
+    """
+
+    def __init__(self, client, cache=None, chunk_size=100, max_workers=8):
+        self.client = client
+        self.cache = cache if cache is not None else LRUCache()
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+
+        # schema name -> definition
+        self._definitions = {}
+
+    def resolve(self, schema_name, items, paths):
+        """Replaces references in items in place, returns items.
+
+        args:
+            schema_name: name of the schema items belong to
+            items: list of entity dicts
+            paths: list of dotted paths of reference fields, the referenced
+                schemas are looked up in the schema definition, or a dict
+                mapping paths to referenced schema names
+
+        References to entities that do not exist are left as they are.
+
+        """
+        objs = items._result if isinstance(items, Response) else items
+
+        if not isinstance(paths, dict):
+            paths = dict((path, self._get_ref(schema_name, path))
+                         for path in paths)
+
+        # (referenced schema name, id) -> referenced entity
+        resolved = {}
+        # referenced schema name -> set of ids to fetch
+        missing = {}
+        for path, ref in paths.items():
+            ids = missing.setdefault(ref, set())
+
+            def collect(value):
+                key = (ref, value)
+                if _is_id(value) and key not in resolved:
+                    cached = self.cache.get(key)
+                    if cached is None:
+                        ids.add(value)
+                    else:
+                        resolved[key] = cached
+                return value
+
+            _walk(objs, path.split('.'), collect)
+
+        resolved.update(self._fetch(missing))
+
+        for path, ref in paths.items():
+            def attach(value):
+                if not _is_id(value) or (ref, value) not in resolved:
+                    return value
+                return dict(resolved[(ref, value)])
+
+            _walk(objs, path.split('.'), attach)
+
+        return items
+
+    def _fetch(self, missing):
+        fetched = {}
+        futures = []
+        with self.client.batch(max_workers=self.max_workers) as batch:
+            for ref, ids in missing.items():
+                ids = sorted(ids)
+                for i in range(0, len(ids), self.chunk_size):
+                    query = {'q': {'_id': {'$in': ids[i:i + self.chunk_size]}}}
+                    futures.append((ref, batch.submit(
+                        self.client.entities(ref).fetch_all, query)))
+
+        for ref, future in futures:
+            for entity in future.result():
+                key = (ref, entity['_id'])
+                fetched[key] = entity
+                self.cache.put(key, entity)
+        return fetched
+
+    def _get_ref(self, schema_name, path):
+        if schema_name not in self._definitions:
+            schema = self.client.schemas.get(schema_name)
+            self._definitions[schema_name] = schema['definition']
+
+        node = self._definitions[schema_name]
+        for key in path.split('.'):
+            # arrays of sub documents
+            if isinstance(node, list):
+                node = node[0] if node else None
+            if not isinstance(node, dict):
+                node = None
+                break
+            node = node.get(key)
+
+        # arrays of references
+        if isinstance(node, list):
+            node = node[0] if node else None
+        if not isinstance(node, dict) or 'ref' not in node:
+            raise Error('{0} of schema {1} is not a reference field'
+                        .format(path, schema_name))
+        return node['ref']
+
+
+def _is_id(value):
+    return value is not None and not isinstance(value, (dict, list))
+
+
+def _walk(obj, keys, fn):
+    """Replaces each value at path keys in obj by fn(value), descending
+    into lists"""
+    if isinstance(obj, list):
+        for item in obj:
+            _walk(item, keys, fn)
+        return
+
+    if not isinstance(obj, dict) or keys[0] not in obj:
+        return
+
+    if len(keys) > 1:
+        _walk(obj[keys[0]], keys[1:], fn)
+    elif isinstance(obj[keys[0]], list):
+        obj[keys[0]] = [fn(v) for v in obj[keys[0]]]
+    else:
+        obj[keys[0]] = fn(obj[keys[0]])
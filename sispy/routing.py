@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+import weakref
+
+from . import Error, NullHandler
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+# all routers, reset in forked children
+_instances = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for router in list(_instances):
+        router.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class Node(object):
+
+    """A SIS API node and its recent request statistics"""
+
+    def __init__(self, base_uri):
+        self.base_uri = base_uri
+
+        # exponentially weighted moving average of the latency in seconds
+        self.latency = None
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.ejected_until = None
+        self.probing = False
+        self.last_used = 0
+
+        # counters
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    def stats(self):
+        """Returns a dict with the node's statistics"""
+        return {
+            'base_uri': self.base_uri,
+            'latency': self.latency,
+            'in_flight': self.in_flight,
+            'healthy': self.ejected_until is None,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejections': self.ejections,
+        }
+
+
+class Router(object):
+
+    """Selects the node a request is sent to.
+
+        - writes go to the first healthy node in the order given
+        - reads go to the healthy node with the lowest latency EWMA,
+          weighted by the number of requests in flight. A node not used
+          for explore_interval seconds is picked to refresh its latency
+        - a node failing max_failures requests in a row (connection errors
+          and 5xx responses) is ejected. Once eject_time has passed probe
+          (a callable taking the node, returning True if it is healthy) is
+          run in the background and the node only gets traffic again once
+          a probe succeeds
+
+    """
+
+    def __init__(self, base_uris, probe, max_failures=3, eject_time=30,
+                 explore_interval=10, alpha=0.3):
+        self.nodes = [Node(base_uri) for base_uri in base_uris]
+        self.probe = probe
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.explore_interval = explore_interval
+        self.alpha = alpha
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+        _instances.add(self)
+
+    def after_fork(self):
+        """Resets the state inherited from the parent process if called in
+        a forked child, keeping the latency statistics.
+        Called in the child at fork time where os.register_at_fork is
+        available"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._lock = threading.Lock()
+        for n in self.nodes:
+            n.in_flight = 0
+            # probe threads do not survive the fork
+            n.probing = False
+        # published last, other threads then use the new lock
+        self._pid = pid
+
+    def select(self, write=False, exclude=()):
+        """Returns the node to send a request to and marks it in flight"""
+        with self._lock:
+            now = time.time()
+            self._start_probes(now)
+
+            healthy = [n for n in self.nodes
+                       if n.ejected_until is None and n not in exclude]
+            if not healthy:
+                # every node is ejected, fall back to the one
+                # that was ejected first rather than failing
+                candidates = [n for n in self.nodes if n not in exclude]
+                node = min(candidates or self.nodes,
+                           key=lambda n: n.ejected_until or 0)
+            elif write:
+                node = healthy[0]
+            else:
+                node = self._select_read(healthy, now)
+
+            node.in_flight += 1
+            node.last_used = now
+            return node
+
+    def report(self, node, latency, error=None):
+        """Records the outcome of a request sent to node"""
+        with self._lock:
+            node.in_flight -= 1
+            node.requests += 1
+
+            if error is not None and _is_node_failure(error):
+                node.failures += 1
+                node.consecutive_failures += 1
+                if node.consecutive_failures >= self.max_failures and \
+                        node.ejected_until is None:
+                    self._eject(node, time.time())
+                return
+
+            node.consecutive_failures = 0
+            if node.latency is None:
+                node.latency = latency
+            else:
+                node.latency = (self.alpha * latency +
+                                (1 - self.alpha) * node.latency)
+
+    def stats(self):
+        """Returns a list of per node statistics dicts"""
+        with self._lock:
+            return [n.stats() for n in self.nodes]
+
+    def _select_read(self, healthy, now):
+        for n in healthy:
+            if n.latency is None or \
+                    now - n.last_used >= self.explore_interval:
+                return n
+        return min(healthy, key=lambda n: n.latency * (1 + n.in_flight))
+
+    def _eject(self, node, now):
+        LOG.warning('ejecting {0} after {1} consecutive failures'
+                    .format(node.base_uri, node.consecutive_failures))
+        node.ejected_until = now + self.eject_time
+        node.ejections += 1
+
+    def _start_probes(self, now):
+        # called with self._lock held
+        for n in self.nodes:
+            if n.ejected_until is not None and not n.probing and \
+                    now >= n.ejected_until:
+                n.probing = True
+                t = threading.Thread(target=self._probe, args=(n,),
+                                     name='sispy-probe')
+                t.daemon = True
+                t.start()
+
+    def _probe(self, node):
+        try:
+            healthy = self.probe(node)
+        except Exception:
+            LOG.debug('probe of {0} failed'.format(node.base_uri),
+                      exc_info=True)
+            healthy = False
+
+        with self._lock:
+            node.probing = False
+            if healthy:
+                LOG.info('{0} is healthy again'.format(node.base_uri))
+                node.ejected_until = None
+                node.consecutive_failures = 0
+                # re-measure before trusting the old latency
+                node.latency = None
+            else:
+                node.ejected_until = time.time() + self.eject_time
+
+
+def _is_node_failure(error):
+    if isinstance(error, Error):
+        return error.http_status_code is None or \
+            error.http_status_code >= 500
+    # connection errors and timeouts
+    return True
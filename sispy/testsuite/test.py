@@ -9,6 +9,7 @@ class Test(unittest.TestCase):
     def __init__(
         self, url, username, password, owner, 
         test_schema_name='python_client_test',
+        http_handler=None,
     ):
         super(Test, self).__init__()
 
@@ -17,9 +18,10 @@ class Test(unittest.TestCase):
         self.password = password
         self.owner = owner
         self.test_schema_name = test_schema_name    
+        self.http_handler = http_handler
 
     def setUp(self):
-        self.client = Client(url=self.url)
+        self.client = Client(url=self.url, http_handler=self.http_handler)
 
         # auth
         self.client.authenticate(self.username, self.password)
@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+
+"""
+Behaviour tests of the client features, run offline against the
+in-memory emulator.
+
+    python -m pytest sispy/testsuite
+"""
+import json
+import os
+import threading
+import time
+import unittest
+
+from sispy import Client, Error, ConflictError, http
+from sispy.emulator import EmulatorHandler
+from sispy.futures import Future, FutureTimeout
+from sispy.governor import Governor
+from sispy import testsuite
+
+URL = 'http://sis.emulator'
+
+
+def new_client(handler=None, **kwargs):
+    kwargs.setdefault('governor', False)
+    client = Client(url=kwargs.pop('url', URL),
+                    http_handler=handler or EmulatorHandler(), **kwargs)
+    client.authenticate('test', 'test')
+    return client
+
+
+def create_schema(client, name, definition):
+    return client.schemas.create({
+        'name': name,
+        '_sis': {'owner': 'test'},
+        'definition': definition,
+    })
+
+
+class FlakyHandler(EmulatorHandler):
+
+    """Emulator failing the requests for which fail(request) returns an
+    exception"""
+
+    def __init__(self, fail=None, *args, **kwargs):
+        super(FlakyHandler, self).__init__(*args, **kwargs)
+        self.fail = fail
+
+    def request(self, request):
+        error = self.fail(request) if self.fail else None
+        if error is not None:
+            raise error
+        return super(FlakyHandler, self).request(request)
+
+
+class TestSuiteTest(unittest.TestCase):
+
+    def test_suite(self):
+        result = unittest.TestResult()
+        testsuite.Test(URL, 'test', 'test', 'test',
+                       http_handler=EmulatorHandler()).run(result)
+        self.assertTrue(result.wasSuccessful(),
+                        result.errors + result.failures)
+
+
+class FutureTest(unittest.TestCase):
+
+    def test_result(self):
+        future = Future()
+        called = []
+        future.add_done_callback(called.append)
+        self.assertRaises(FutureTimeout, future.result, 0.01)
+
+        future.set_result(1)
+        self.assertEqual(future.result(), 1)
+        self.assertEqual(called, [future])
+
+        # resolving twice is a no-op
+        future.set_exception(Error('late'))
+        self.assertIsNone(future.exception())
+
+    def test_exception(self):
+        future = Future()
+        future.set_exception(Error('failed'))
+        self.assertRaises(Error, future.result)
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = EmulatorHandler()
+        self.client = new_client(self.handler)
+        create_schema(self.client, 'writer_test', {'n': 'Number'})
+        self.endpoint = self.client.entities('writer_test')
+
+    def test_success_and_errors(self):
+        with self.endpoint.writer(flush_interval=None) as writer:
+            created = [writer.create({'n': i}) for i in range(3)]
+        items = [f.result() for f in created]
+        self.assertEqual([item['n'] for item in items], [0, 1, 2])
+
+        with self.endpoint.writer(flush_interval=None) as writer:
+            updated = writer.update(items[0]['_id'], {'n': 10})
+            missing = writer.update('missing', {'n': 11})
+            deleted = writer.delete(items[1]['_id'])
+            not_found = writer.delete('missing')
+
+        self.assertEqual(updated.result()['n'], 10)
+        self.assertEqual(missing.exception().code, 404)
+        self.assertEqual(deleted.result()['_id'], items[1]['_id'])
+        self.assertIsInstance(not_found.exception(), Error)
+        self.assertEqual(len(self.endpoint.fetch_all()), 2)
+
+    def test_create_errors(self):
+        with self.endpoint.writer(flush_interval=None) as writer:
+            ok = writer.create({'n': 0})
+            bad = writer.create('not an object')
+
+        self.assertEqual(ok.result()['n'], 0)
+        self.assertEqual(bad.exception().code, 400)
+
+    def test_entities_only(self):
+        self.assertRaises(Error, self.client.schemas.writer)
+
+    def test_operation_order(self):
+        sent = []
+        handler = self.client._http_handler
+
+        class Recorder(http.BaseHTTPHandler):
+            def request(self, request):
+                sent.append(request.method)
+                return handler.request(request)
+
+        self.client._http_handler = Recorder()
+        with self.endpoint.writer(flush_interval=None) as writer:
+            writer.update('x', {'n': 1})
+            writer.delete('y')
+            writer.create({'_id': 'y', 'n': 2})
+            writer.create({'_id': 'z', 'n': 3})
+
+        # the delete of y is sent before its create
+        self.assertEqual(sent, ['PUT', 'DELETE', 'POST'])
+
+    def test_merged_updates(self):
+        item = self.endpoint.create({'n': 0})
+        before = self.handler.stats()['requests']
+
+        writer = self.endpoint.writer(flush_interval=None)
+        futures = [writer.update(item['_id'], {'n': i}) for i in range(5)]
+        futures.append(writer.update(item['_id'], {'s': 'x'}))
+        # merged updates count as one pending operation
+        self.assertEqual(writer._pending, 1)
+        writer.close()
+
+        self.assertEqual(self.handler.stats()['requests'] - before, 1)
+        for f in futures:
+            self.assertEqual(f.result()['n'], 4)
+        stored = self.endpoint.get(item['_id'])
+        self.assertEqual((stored['n'], stored['s']), (4, 'x'))
+
+    def test_merged_nested_updates(self):
+        item = self.endpoint.create({'n': 0, 's': 'a', '_sis': {
+            'tags': ['t'], 'owner': ['a']}})
+        tags = {'_sis': {'tags': ['x']}}
+
+        with self.endpoint.writer(flush_interval=None) as writer:
+            writer.update(item['_id'], tags)
+            writer.update(item['_id'], {'_sis': {'owner': ['b']}, 's': None})
+
+        stored = self.endpoint.get(item['_id'])
+        self.assertEqual(stored['_sis'], {'tags': ['x'], 'owner': ['b']})
+        self.assertNotIn('s', stored)
+        # the caller's content is left untouched
+        self.assertEqual(tags, {'_sis': {'tags': ['x']}})
+
+    def test_thresholds(self):
+        with self.endpoint.writer(max_ops=10, flush_interval=None) as writer:
+            futures = [writer.create({'n': i}) for i in range(9)]
+            time.sleep(0.05)
+            self.assertFalse(futures[0].done())
+            # a full batch is sent by the background thread
+            futures.append(writer.create({'n': 9}))
+            for f in futures:
+                f.result(5)
+
+        writer = self.endpoint.writer(flush_interval=0.05)
+        future = writer.create({'n': 0})
+        self.assertEqual(future.result(5)['n'], 0)
+        writer.close()
+
+    def test_request_failure(self):
+        def fail(request):
+            if '/entities/' in request.uri:
+                return Error('unavailable', http_status_code=503)
+
+        self.endpoint.client = new_client(FlakyHandler(fail))
+        with self.endpoint.writer(flush_interval=None) as writer:
+            futures = [writer.create({'n': i}) for i in range(3)]
+        for f in futures:
+            self.assertEqual(f.exception().http_status_code, 503)
+
+    def test_unexpected_response(self):
+        class Handler(EmulatorHandler):
+            def request(self, request):
+                response = super(Handler, self).request(request)
+                if request.method == 'POST' and '/entities/' in request.uri:
+                    # not a bulk result
+                    response._result = response['success'][0]
+                return response
+
+        self.endpoint.client = new_client(Handler())
+        self.endpoint.client.schemas.create(
+            {'name': 'writer_test', 'definition': {'n': 'Number'}})
+        writer = self.endpoint.writer(max_ops=2, flush_interval=None)
+        futures = [writer.create({'n': i}) for i in range(2)]
+        for f in futures:
+            self.assertIsInstance(f.exception(5), KeyError)
+
+        # the background thread keeps flushing
+        writer.update('missing', {'n': 0})
+        future = writer.update('missing2', {'n': 0})
+        self.assertEqual(future.exception(5).code, 404)
+        writer.close()
+
+    def test_callbacks_may_buffer(self):
+        # operations buffered from callbacks run on the flushing thread
+        # must not wait for that thread to make space
+        writer = self.endpoint.writer(max_ops=1, max_pending=1,
+                                      flush_interval=None)
+        done = threading.Event()
+        results = []
+
+        def chain(future):
+            results.append(future.result())
+            if len(results) < 20:
+                writer.create({'n': len(results)}).add_done_callback(chain)
+            else:
+                done.set()
+
+        writer.create({'n': 0}).add_done_callback(chain)
+        self.assertTrue(done.wait(5))
+        writer.close()
+        self.assertEqual(len(self.endpoint.fetch_all()), 20)
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = EmulatorHandler()
+        self.client = new_client(self.handler)
+        create_schema(self.client, 'owner_test', {'name': 'String'})
+        owners = self.client.entities('owner_test')
+        self.owners = [owners.create({'name': 'o{0}'.format(i)})
+                       for i in range(5)]
+
+    def test_watch(self):
+        since = (0, '')
+        events = self.client.entities('owner_test').watch(
+            interval=0.01, since=since, delete_interval=0, page_size=2)
+        seen = [next(events) for _ in range(5)]
+        self.assertEqual([e for e, _ in seen], ['created'] * 5)
+        self.assertEqual([item['_id'] for _, item in seen],
+                         [owner['_id'] for owner in self.owners])
+
+        owners = self.client.entities('owner_test')
+        owners.update(self.owners[2]['_id'], {'name': 'x'})
+        owners.delete(self.owners[3]['_id'])
+
+        changes = dict(next(events) for _ in range(2))
+        self.assertEqual(changes['updated']['name'], 'x')
+        self.assertEqual(changes['deleted'], {'_id': self.owners[3]['_id']})
+
+
+class CasTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = new_client()
+        create_schema(self.client, 'cas_test', {
+            'n': 'Number', 's': 'String', 'tags': ['String'],
+            'nested': {'a': 'Number', 'b': 'Number'},
+        })
+        self.endpoint = self.client.entities('cas_test')
+        self.item = self.endpoint.create({'n': 1, 's': 'a'})
+
+    def test_cas_conflict(self):
+        id = self.item['_id']
+        response = self.endpoint.update(id, {'n': 2}, expect={'n': 1})
+        self.assertEqual(response['n'], 2)
+
+        with self.assertRaises(ConflictError) as cm:
+            self.endpoint.update(id, {'n': 3}, expect={'n': 1})
+        self.assertEqual(cm.exception.current['n'], 2)
+        self.assertEqual(self.endpoint.get(id)['n'], 2)
+
+        # other errors are not conflicts
+        with self.assertRaises(Error) as cm:
+            self.endpoint.update('missing', {'n': 3}, expect={'n': 1})
+        self.assertNotIsInstance(cm.exception, ConflictError)
+
+    def test_update_with_retry(self):
+        id = self.item['_id']
+        self.endpoint.update(id, {'n': 5})
+        merged = []
+
+        def merge(current, content):
+            merged.append(current['n'])
+            return {'n': current['n'] + 1}
+
+        response = self.endpoint.update_with_retry(id, {'n': 2}, {'n': 1},
+                                                   merge)
+        self.assertEqual(response['n'], 6)
+        self.assertEqual(merged, [5])
+
+        def conflicting(current, content):
+            # a concurrent writer wins every time
+            self.endpoint.update(id, {'n': current['n'] + 1})
+            return content
+
+        self.assertRaises(ConflictError, self.endpoint.update_with_retry,
+                          id, {'s': 'b'}, {'n': 0}, conflicting,
+                          max_retries=2)
+        self.assertEqual(self.endpoint.get(id)['n'], 8)
+
+    def test_update_bulk_expect(self):
+        other = self.endpoint.create({'n': 2})
+        response = self.endpoint.update_bulk(
+            [{'_id': self.item['_id'], 's': 'x'},
+             {'_id': other['_id'], 's': 'x'}], expect={'n': 1})
+        self.assertEqual([item['_id'] for item in response['success']],
+                         [self.item['_id']])
+        self.assertEqual(len(response['errors']), 1)
+
+
+class GovernorTest(unittest.TestCase):
+
+    def test_retry_after(self):
+        overloaded = [3]
+
+        def fail(request):
+            if overloaded[0]:
+                overloaded[0] -= 1
+                return Error('slow down', http_status_code=429,
+                             headers={'Retry-After': '0.2'})
+
+        governor = Governor(initial_concurrency=8)
+        client = Client(url=URL, governor=governor,
+                        http_handler=FlakyHandler(fail))
+
+        self.assertRaises(Error, client.schemas.fetch_page)
+        stats = governor.stats()
+        self.assertEqual(stats['limit'], 4)
+        self.assertEqual(stats['overloads'], 1)
+        self.assertGreater(stats['paused_for'], 0.1)
+
+        # requests wait for the pause
+        start = time.time()
+        self.assertRaises(Error, client.schemas.fetch_page)
+        self.assertGreater(time.time() - start, 0.1)
+
+    def test_aimd(self):
+        governor = Governor(initial_concurrency=4, max_concurrency=6)
+        for _ in range(100):
+            governor.release(governor.acquire())
+        self.assertEqual(governor.stats()['limit'], 6)
+
+        governor.release(governor.acquire(),
+                         Error('unavailable', http_status_code=503))
+        self.assertEqual(governor.stats()['limit'], 3)
+        # client errors do not shrink the limit
+        governor.release(governor.acquire(),
+                         Error('not found', http_status_code=404))
+        self.assertEqual(governor.stats()['limit'], 3)
+
+    def test_concurrency_limit(self):
+        governor = Governor(initial_concurrency=2, max_concurrency=2)
+        client = new_client(EmulatorHandler(latency=0.02),
+                            governor=governor)
+        peak = [0]
+        lock = threading.Lock()
+        release = governor.release
+
+        def tracking_release(start, error=None):
+            with lock:
+                peak[0] = max(peak[0], governor.in_flight)
+            release(start, error)
+
+        governor.release = tracking_release
+        with client.batch(max_workers=8) as batch:
+            for _ in range(16):
+                batch.submit(client.schemas.fetch_page)
+        self.assertEqual(peak[0], 2)
+        self.assertEqual(governor.stats()['in_flight'], 0)
+
+
+class RouterTest(unittest.TestCase):
+
+    def test_ejection_and_probe(self):
+        down = set(['http://b'])
+
+        def fail(request):
+            if any(request.uri.startswith(u) for u in down):
+                return IOError('connection refused')
+
+        handler = FlakyHandler(fail)
+        client = new_client(handler, url=['http://a', 'http://b'],
+                            router_options={'max_failures': 2,
+                                            'eject_time': 0.05})
+        create_schema(client, 'router_test', {'n': 'Number'})
+        self.assertEqual(client.node_stats()[1]['healthy'], True)
+
+        # reads failing on b are retried on a, b is eventually ejected
+        for _ in range(4):
+            client.schemas.get('router_test')
+        stats = client.node_stats()
+        self.assertFalse(stats[1]['healthy'])
+        self.assertEqual(stats[1]['ejections'], 1)
+
+        # probes keep failing while b is down
+        time.sleep(0.1)
+        client.schemas.get('router_test')
+        time.sleep(0.05)
+        self.assertFalse(client.node_stats()[1]['healthy'])
+
+        down.clear()
+        deadline = time.time() + 5
+        while not client.node_stats()[1]['healthy']:
+            self.assertLess(time.time(), deadline)
+            client.schemas.get('router_test')
+            time.sleep(0.02)
+        self.assertEqual(client.node_stats()[1]['ejections'], 1)
+
+    def test_writes_are_not_retried(self):
+        handler = FlakyHandler(
+            lambda r: IOError('down') if r.method == 'POST' else None)
+        client = Client(url=['http://a', 'http://b'], governor=False,
+                        http_handler=handler)
+        self.assertRaises(IOError, client.schemas.create,
+                          {'name': 'x', 'definition': {'n': 'Number'}})
+        self.assertEqual([n['requests'] for n in client.node_stats()],
+                         [1, 0])
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = EmulatorHandler()
+        self.client = new_client(self.handler)
+        create_schema(self.client, 'owner_test', {'name': 'String'})
+        create_schema(self.client, 'ref_test', {
+            'n': 'Number',
+            'owner': {'type': 'ObjectId', 'ref': 'owner_test'},
+        })
+        owners = self.client.entities('owner_test')
+        self.owners = [owners.create({'name': 'o{0}'.format(i)})
+                       for i in range(5)]
+        self.endpoint = self.client.entities('ref_test')
+        self.endpoint.create([{'n': i, 'owner': self.owners[i % 5]['_id']}
+                              for i in range(450)])
+
+    def test_batch(self):
+        with self.client.batch(max_workers=4) as batch:
+            for owner in self.owners:
+                batch.submit(self.client.entities('owner_test').get,
+                             owner['_id'])
+            batch.submit(self.endpoint.get, 'missing')
+            results = batch.results()
+
+        self.assertEqual([r['name'] for r in results[:-1]],
+                         ['o0', 'o1', 'o2', 'o3', 'o4'])
+        self.assertEqual(results[-1].http_status_code, 404)
+
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = EmulatorHandler()
+        self.client = new_client(self.handler)
+        create_schema(self.client, 'owner_test', {'name': 'String'})
+        create_schema(self.client, 'ref_test', {
+            'n': 'Number',
+            'owner': {'type': 'ObjectId', 'ref': 'owner_test'},
+        })
+        owners = self.client.entities('owner_test')
+        self.owners = [owners.create({'name': 'o{0}'.format(i)})
+                       for i in range(5)]
+        self.endpoint = self.client.entities('ref_test')
+        self.endpoint.create([{'n': i, 'owner': self.owners[i % 5]['_id']}
+                              for i in range(450)])
+
+    def test_resolve(self):
+        before = self.handler.stats()['requests']
+        items = self.endpoint.fetch_all(resolve=['owner'])
+        # 3 pages, the schema definition, the 5 owners fetched once
+        self.assertEqual(self.handler.stats()['requests'] - before, 5)
+        for item in items:
+            self.assertEqual(item['owner'],
+                             self.owners[item['n'] % 5].to_dict())
+
+        # referenced entities are cached across calls
+        before = self.handler.stats()['requests']
+        self.endpoint.fetch_all(resolve=['owner'])
+        self.assertEqual(self.handler.stats()['requests'] - before, 3)
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = new_client()
+        create_schema(self.client, 'projection_test', {
+            'n': 'Number', 's': 'String', 'tags': ['String'],
+            'nested': {'a': 'Number', 'b': 'Number'},
+        })
+        self.endpoint = self.client.entities('projection_test')
+        self.item = self.endpoint.create({'n': 1, 's': 'a'})
+
+    def test_fetch_all(self):
+        handler = self.client._http_handler
+        self.endpoint.create([{'n': i, 's': 'x'} for i in range(449)])
+        before = handler.stats()['requests']
+        items = self.endpoint.fetch_all(fields=['n'])
+        self.assertEqual(len(items), 450)
+        self.assertEqual(sorted(item['n'] for item in items),
+                         sorted([1] + list(range(449))))
+        self.assertNotIn('s', items[0])
+        # 200 items per page
+        self.assertEqual(handler.stats()['requests'] - before, 3)
+
+    def test_diff_update(self):
+        original = self.endpoint.update(self.item['_id'], {
+            'tags': ['a'], 'nested': {'a': 1, 'b': 2},
+        })
+        modified = original.to_dict()
+        modified['s'] = 'b'
+        modified['nested'] = {'a': 1, 'b': 3}
+        modified['_updated'] = 0
+        del modified['tags']
+
+        sent = []
+        handler = self.client._http_handler
+
+        class Recorder(http.BaseHTTPHandler):
+            def request(self, request):
+                sent.append(request)
+                return handler.request(request)
+
+        self.client._http_handler = Recorder()
+        response = self.endpoint.diff_update(original, modified)
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(json.loads(sent[0].body),
+                         {'s': 'b', 'nested': {'b': 3}, 'tags': None})
+        self.assertEqual(response['s'], 'b')
+        self.assertEqual(response['nested'], {'a': 1, 'b': 3})
+
+        self.assertIsNone(self.endpoint.diff_update(response, response))
+        self.assertEqual(len(sent), 1)
+
+        # no collection wide update without an id
+        self.assertRaises(Error, self.endpoint.diff_update,
+                          {'n': 1}, {'n': 2})
+        self.assertEqual(len(sent), 1)
+
+
+class ForkTest(unittest.TestCase):
+
+    def test_reset_in_child(self):
+        resets = []
+
+        class Handler(EmulatorHandler):
+            def reset(self):
+                resets.append(True)
+
+        client = new_client(Handler(), url=['http://a', 'http://b'],
+                            governor=Governor(), warm_up_connections=2)
+        client.schemas.fetch_page()
+        self.assertEqual(resets, [])
+
+        # pretend the client was inherited from another process
+        client._pid = -1
+        client.governor._pid = -1
+        client.governor.in_flight = 3
+        client.schemas.fetch_page()
+        self.assertEqual(resets, [True])
+        self.assertEqual(client.governor.stats()['in_flight'], 0)
+
+        client.after_fork()
+        self.assertEqual(resets, [True])
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'),
+                         'os.register_at_fork is not available')
+    def test_locks_held_at_fork(self):
+        governor = Governor()
+        clients = [new_client(url=['http://a', 'http://b'],
+                              governor=governor) for _ in range(2)]
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            # a parent thread holds the shared locks at fork time
+            with governor._cond:
+                with clients[0].router._lock:
+                    held.set()
+                    done.wait(5)
+
+        t = threading.Thread(target=hold)
+        t.start()
+        held.wait(5)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    # reset at fork time, before any client notices
+                    reset = [governor._pid, clients[0].router._pid,
+                             clients[0].resolver.cache._pid]
+                    threads = [threading.Thread(target=c.schemas.fetch_page)
+                               for c in clients]
+                    for th in threads:
+                        th.start()
+                    for th in threads:
+                        th.join(5)
+                    if reset == [os.getpid()] * 3 and \
+                            not any(th.is_alive() for th in threads):
+                        status = 0
+                finally:
+                    os._exit(status)
+        finally:
+            done.set()
+            t.join()
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
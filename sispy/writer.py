@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import json
+import threading
+import time
+
+from . import Error, NullHandler
+from .futures import Future
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(NullHandler())
+
+
+class BulkWriter(object):
+
+    """Buffers single item create/update/delete operations and sends them
+    as bulk requests.
+
+    Buffered operations are flushed from a background thread when one of
+    the thresholds is reached:
+        max_ops: number of buffered operations
+        max_bytes: approximate size of the buffered JSON payload
+        flush_interval: age in seconds of the oldest buffered operation
+
+    Repeated updates of the same id are merged into a single update,
+    nested objects field by field like the server applies partial updates.
+    Producers block while max_pending operations are buffered.
+
+    Each operation returns a Future that resolves to the item reported in
+    the 'success' list of the bulk response, or fails with sispy.Error if
+    the item is reported in 'errors' or the whole request fails. Futures
+    are resolved by the flushing thread once the batch is sent, callbacks
+    running on the background thread may buffer further operations without
+    being subject to max_pending.
+
+    """
+
+    def __init__(self, endpoint, max_ops=100, max_bytes=1024 * 1024,
+                 flush_interval=1.0, max_pending=1000):
+        self.endpoint = endpoint
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        # the buffer must be able to hold at least one full batch
+        self.max_pending = max(max_pending, max_ops)
+
+        self._cond = threading.Condition()
+        # serializes sending so that batches go out in the buffered order
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._reset_buffer()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='sispy-bulk-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def create(self, content):
+        """Buffers a create, returns a Future"""
+        future = Future()
+        id = content.get('_id') if isinstance(content, dict) else None
+        while True:
+            with self._cond:
+                self._wait_for_space()
+                if id is None or (id not in self._updates and
+                                  id not in self._deletes):
+                    self._creates.append((content, future))
+                    self._added(self._size(content))
+                    return future
+            # creates are sent first, flush a pending update or delete of
+            # the same id to keep the operation order
+            self.flush()
+
+    def update(self, id, content):
+        """Buffers an update of the item with the given id,
+        returns a Future.
+
+        Content is merged into a pending update of the same id if any.
+
+        """
+        future = Future()
+        while True:
+            with self._cond:
+                self._wait_for_space()
+                if id not in self._deletes:
+                    if id in self._updates:
+                        changes, futures = self._updates[id]
+                        _merge(changes, content)
+                        futures.append(future)
+                        # only count the growth of the merged update
+                        size = self._size(changes)
+                        self._added(size - self._update_sizes[id],
+                                    merged=True)
+                        self._update_sizes[id] = size
+                    else:
+                        changes = copy.deepcopy(content)
+                        self._updates[id] = (changes, [future])
+                        self._update_ids.append(id)
+                        self._update_sizes[id] = self._size(changes)
+                        self._added(self._update_sizes[id])
+                    return future
+            # a delete of the same id is pending, keep the operation order
+            self.flush()
+
+    def delete(self, id):
+        """Buffers a delete of the item with the given id,
+        returns a Future.
+
+        """
+        future = Future()
+        while True:
+            with self._cond:
+                self._wait_for_space()
+                if id not in self._updates:
+                    if id in self._deletes:
+                        self._deletes[id].append(future)
+                    else:
+                        self._deletes[id] = [future]
+                        self._delete_ids.append(id)
+                        self._added(self._size(id))
+                    return future
+            # an update of the same id is pending, keep the operation order
+            self.flush()
+
+    def flush(self):
+        """Sends all buffered operations from the calling thread"""
+        outcomes = []
+        with self._send_lock:
+            with self._cond:
+                creates = self._creates
+                updates = [(id, self._updates[id])
+                           for id in self._update_ids]
+                deletes = [(id, self._deletes[id])
+                           for id in self._delete_ids]
+                self._reset_buffer()
+                # wake up producers waiting for space
+                self._cond.notify_all()
+
+            for i in range(0, len(creates), self.max_ops):
+                ops = creates[i:i + self.max_ops]
+                outcomes.extend(self._send(
+                    self._send_creates, ops,
+                    [future for _, future in ops]))
+
+            for i in range(0, len(updates), self.max_ops):
+                ops = updates[i:i + self.max_ops]
+                outcomes.extend(self._send(
+                    self._send_updates, ops,
+                    [f for _, (_, futures) in ops for f in futures]))
+
+            for i in range(0, len(deletes), self.max_ops):
+                ops = deletes[i:i + self.max_ops]
+                outcomes.extend(self._send(
+                    self._send_deletes, ops,
+                    [f for _, futures in ops for f in futures]))
+
+        # resolve outside of the send lock, callbacks may buffer or
+        # flush further operations
+        for future, result, exception in outcomes:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Flushes buffered operations and stops the background thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def _reset_buffer(self):
+        self._creates = []
+        self._updates = {}
+        self._update_ids = []
+        self._update_sizes = {}
+        self._deletes = {}
+        self._delete_ids = []
+        self._pending = 0
+        self._bytes = 0
+        self._first_ts = None
+
+    def _wait_for_space(self):
+        # called with self._cond held
+        if self._closed:
+            raise Error('{0} is closed'.format(self.__class__.__name__))
+        # the background thread is the one making space, future callbacks
+        # it runs must not wait for it
+        if threading.current_thread() is self._thread:
+            return
+        while self._pending >= self.max_pending and not self._closed:
+            self._cond.wait()
+        if self._closed:
+            raise Error('{0} is closed'.format(self.__class__.__name__))
+
+    def _size(self, content):
+        if not self.max_bytes:
+            return 0
+        return len(json.dumps(content))
+
+    def _added(self, size, merged=False):
+        # called with self._cond held
+        if not merged:
+            self._pending += 1
+        self._bytes += size
+        if self._first_ts is None:
+            self._first_ts = time.time()
+            # the background thread waits without a timeout while the
+            # buffer is empty, wake it up to wait for flush_interval
+            self._cond.notify_all()
+        elif self._should_flush():
+            self._cond.notify_all()
+
+    def _should_flush(self):
+        if not self._pending:
+            return False
+        if self._pending >= self.max_ops:
+            return True
+        if self.max_bytes and self._bytes >= self.max_bytes:
+            return True
+        if self.flush_interval is not None:
+            return time.time() - self._first_ts >= self.flush_interval
+        return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._should_flush():
+                    timeout = None
+                    if self._pending and self.flush_interval is not None:
+                        timeout = max(0, self._first_ts +
+                                      self.flush_interval - time.time())
+                    self._cond.wait(timeout)
+                if self._closed:
+                    # close() flushes whatever is left
+                    return
+            try:
+                self.flush()
+            except Exception:
+                # keep flushing later operations
+                LOG.exception('bulk writer flush failed')
+
+    def _send(self, send, ops, futures):
+        """Returns the list of (future, result, exception) outcomes of
+        send(ops), all the futures fail if the request fails or its
+        response cannot be mapped to the operations"""
+        try:
+            return send(ops)
+        except Exception as e:
+            return _failed(futures, e)
+
+    def _send_creates(self, ops):
+        response = self.endpoint.create([content for content, _ in ops])
+
+        outcomes = []
+        errors = list(response['errors'])
+        remaining = []
+        for content, future in ops:
+            err = _pop_error(errors, lambda item: item == content)
+            if err is not None:
+                outcomes.append((future, None, _item_error(err)))
+            else:
+                remaining.append(future)
+
+        # successfully created items are reported in the request order
+        success = list(response['success'])
+        for future, item in zip(remaining, success):
+            outcomes.append((future, item, None))
+        outcomes.extend(_failed(remaining[len(success):],
+                        Error('no result returned for the created item')))
+        return outcomes
+
+    def _send_updates(self, ops):
+        content = []
+        for id, (changes, _) in ops:
+            item = dict(changes)
+            item['_id'] = id
+            content.append(item)
+
+        response = self.endpoint.update_bulk(content)
+        return self._resolve_by_id(ops, response, lambda op: op[1])
+
+    def _send_deletes(self, ops):
+        query = {'q': {'_id': {'$in': [id for id, _ in ops]}}}
+        response = self.endpoint.delete_bulk(query)
+        return self._resolve_by_id(ops, response, lambda op: op)
+
+    def _resolve_by_id(self, ops, response, get_futures):
+        success = {}
+        for item in response['success']:
+            success[item.get('_id')] = item
+        errors = list(response['errors'])
+
+        outcomes = []
+        for id, op in ops:
+            futures = get_futures(op)
+            if id in success:
+                outcomes.extend((future, success[id], None)
+                                for future in futures)
+                continue
+
+            err = _pop_error(
+                errors, lambda item: isinstance(item, dict) and
+                item.get('_id') == id)
+            if err is not None:
+                error = _item_error(err)
+            else:
+                error = Error('no result returned for {0}'.format(id))
+            outcomes.extend(_failed(futures, error))
+        return outcomes
+
+
+def _merge(changes, content):
+    """Merges content into the pending changes in place, nested objects
+    are merged field by field. None values remove fields on the server
+    and are kept."""
+    for k, v in content.items():
+        if isinstance(v, dict) and isinstance(changes.get(k), dict):
+            _merge(changes[k], v)
+        else:
+            changes[k] = copy.deepcopy(v)
+
+
+def _failed(futures, exception):
+    return [(future, None, exception) for future in futures]
+
+
+def _error_item(err):
+    """Returns the item a bulk error entry refers to, if it can be found"""
+    if isinstance(err, dict):
+        for k in ('value', 'item'):
+            if k in err:
+                return err[k]
+    elif isinstance(err, (list, tuple)):
+        for v in err:
+            if isinstance(v, dict):
+                return v
+    return None
+
+
+def _pop_error(errors, match):
+    for i, err in enumerate(errors):
+        if match(_error_item(err)):
+            return errors.pop(i)
+    return None
+
+
+def _item_error(err):
+    if isinstance(err, dict):
+        return Error(error=str(err.get('error', err)),
+                     code=err.get('code'),
+                     response_dict=err)
+    return Error(error=str(err), response_dict={'error': err})